@@ -28,18 +28,28 @@ Usage:
 """
 
 import asyncio
+import hashlib
+import json
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
-from aiogram import Bot, Dispatcher, F
+import aiodocker
+from aiogram import Bot, Dispatcher, F, html
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command, CommandObject
-from aiogram.types import Message, FSInputFile, ContentType
+from aiogram.types import Message, BufferedInputFile, ContentType
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -47,31 +57,92 @@ load_dotenv()
 # ---- CONFIGURATION ---------------------------------------------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN") or "REPLACE_WITH_YOUR_BOT_TOKEN"
 ADMINS = {int(x) for x in os.getenv("ADMINS", "").split(',') if x.strip()} or {123456789}
-BASE_DIR = Path(os.getenv("DEPLOY_BASE", "~/projects/bots"))
+BASE_DIR = Path(os.getenv("DEPLOY_BASE", "~/projects/bots")).expanduser().resolve()
 DOCKER_RUN_EXTRA = os.getenv("DOCKER_RUN_EXTRA", "")
 DEFAULT_PYTHON_IMAGE = os.getenv("DEFAULT_PYTHON_IMAGE", "python:3.11-slim")
 DOCKER_BUILD_TIMEOUT = 300
+# Label stamped on every container we start, so listings can be filtered
+# to bot-owned containers daemon-side.
+MANAGED_LABEL = "deploybot.managed=true"
+MAX_CONCURRENT_DEPLOYS = int(os.getenv("MAX_CONCURRENT_DEPLOYS", "2"))
+MAX_CONCURRENT_BUILDS = int(os.getenv("MAX_CONCURRENT_BUILDS", "2"))
 # -----------------------------------------------------------------------------
 
+# Telegram caps bots at ~30 messages/sec globally; a token bucket just
+# below that turns bursts into short queuing instead of 429 flood-wait
+# penalties.
+SEND_LIMITER = AsyncLimiter(25, 1)
+
+
+class ThrottlingSessionMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        async with SEND_LIMITER:
+            return await make_request(bot, method)
+
+
 bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(ThrottlingSessionMiddleware())
 dp = Dispatcher()
 
+# Cap concurrent extract+build pipelines so parallel uploads don't thrash
+# disk and the docker daemon.
+DEPLOY_SEM = asyncio.Semaphore(MAX_CONCURRENT_DEPLOYS)
+
+# Builds are the CPU/disk-heavy part, so they get their own tighter gate:
+# MAX_CONCURRENT_DEPLOYS can be raised to overlap download/extract without
+# admitting more simultaneous docker builds.
+BUILD_SEM = asyncio.Semaphore(MAX_CONCURRENT_BUILDS)
+_builds_in_flight = 0
+
+# Per-chat FIFO queues: uploads from the same chat deploy in order, while
+# different chats overlap up to DEPLOY_SEM. Bounded so a flood of uploads
+# gets a "busy" reply instead of piling up tasks.
+DEPLOY_QUEUE_MAXSIZE = 8
+_deploy_queues: dict[int, asyncio.Queue] = {}
+_deploy_workers: dict[int, asyncio.Task] = {}
+
+
+_docker: aiodocker.Docker | None = None
+
+
+def get_docker() -> aiodocker.Docker:
+    """Lazy singleton talking to the Docker Engine API over the unix socket.
+
+    Created on first use so the aiohttp session binds to the running loop.
+    """
+    global _docker
+    if _docker is None:
+        _docker = aiodocker.Docker()
+    return _docker
+
+
+_NAME_SANITIZE_RE = re.compile(r"[^a-z0-9_.-]")
+_DASH_COLLAPSE_RE = re.compile(r"-+")
+_CAPTION_NAME_RE = re.compile(r"name:([a-zA-Z0-9_.-]+)")
+
 
 def sanitize_name(name: str) -> str:
     name = name.lower()
-    name = re.sub(r"[^a-z0-9_.-]", "-", name)
-    name = re.sub(r"-+", "-", name).strip("-")
+    name = _NAME_SANITIZE_RE.sub("-", name)
+    name = _DASH_COLLAPSE_RE.sub("-", name).strip("-")
     return name or f"bot-{int(time.time())}"
 
 
+_base_dir_ensured = False
+
+
 def ensure_base_dir():
+    global _base_dir_ensured
+    if _base_dir_ensured:
+        return
     BASE_DIR.mkdir(parents=True, exist_ok=True)
+    _base_dir_ensured = True
 
 
 
-async def run_cmd(cmd, cwd=None, timeout=None):
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
+async def run_cmd(*args, cwd=None, timeout=None):
+    proc = await asyncio.create_subprocess_exec(
+        *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT,
         cwd=cwd,
@@ -85,38 +156,185 @@ async def run_cmd(cmd, cwd=None, timeout=None):
     return proc.returncode == 0, out.decode(errors="ignore")
 
 
-def generate_default_dockerfile(project_dir: Path):
-    has_req = (project_dir / "requirements.txt").exists()
-    has_pyproject = (project_dir / "pyproject.toml").exists()
+async def run_cmd_streamed(*args, cwd=None, timeout=None, env=None, on_output=None):
+    """Like run_cmd, but reads stdout line by line instead of buffering it.
+
+    Keeps only a bounded tail (enough to show the final error), so memory
+    stays constant for multi-minute builds. If on_output is given it is
+    awaited with the current tail at most once every 3 seconds.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+    )
+    tail = deque(maxlen=200)
+    last_report = 0.0
+
+    async def _consume():
+        nonlocal last_report
+        async for raw in proc.stdout:
+            tail.append(raw.decode(errors="ignore"))
+            now = time.monotonic()
+            if on_output is not None and now - last_report >= 3.0:
+                last_report = now
+                await on_output(list(tail))
+        await proc.wait()
+
+    try:
+        await asyncio.wait_for(_consume(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False, "TIMEOUT"
+    return proc.returncode == 0, "".join(tail)
+
+
+_EXTRACT_WORKERS = 4
+
+
+def _extract_zip(archive_path: Path, dest_dir: Path):
+    """Stream-extract a ZIP member by member.
+
+    Faster than shutil.unpack_archive for many-file archives: one large
+    copy per member instead of small default-sized chunks, zero-byte
+    members are created without opening the compressed stream at all, and
+    non-empty members are decompressed on a small thread pool so per-file
+    syscall latency overlaps. Rejects absolute or parent-relative member
+    paths (Zip-Slip).
+    """
+    with zipfile.ZipFile(archive_path) as zf:
+        infos = zf.infolist()
+
+    # Validate paths and handle directories / empty files serially — that
+    # part is cheap — collecting the members worth parallelising.
+    members = []
+    for zi in infos:
+        parts = Path(zi.filename).parts
+        if os.path.isabs(zi.filename) or ".." in parts:
+            raise ValueError(f"Unsafe path in ZIP: {zi.filename}")
+        dest = dest_dir / zi.filename
+        if zi.is_dir():
+            dest.mkdir(parents=True, exist_ok=True)
+            continue
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if zi.file_size == 0:
+            dest.touch()
+            continue
+        members.append(zi)
+
+    if not members:
+        return
+
+    # ZipFile.open is not safe for concurrent reads on a shared handle, so
+    # each worker thread opens the archive once and reuses it.
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def _extract_one(zi):
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(archive_path)
+            with opened_lock:
+                opened.append(zf)
+        dest = dest_dir / zi.filename
+        # Size both the copy chunk and the write buffer to the member
+        # (capped at 1 MB): one read and one write for small files.
+        buf_size = min(zi.file_size, 1 << 20)
+        with zf.open(zi) as src, open(dest, "wb", buffering=buf_size) as dst:
+            shutil.copyfileobj(src, dst, buf_size)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(_EXTRACT_WORKERS, len(members))) as ex:
+            list(ex.map(_extract_one, members))
+    finally:
+        for zf in opened:
+            zf.close()
+
+
+def _project_hash(project_dir: Path) -> str:
+    """Content hash of the extracted project, used as the image tag.
+
+    Byte-identical re-uploads map to the same tag, so the already-built
+    image is reused and the build is skipped entirely. Hashing only
+    requirements.txt would be cheaper but would wrongly skip rebuilds
+    when the code changed, since the image also copies the sources.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for path in sorted(project_dir.rglob("*")):
+        if path.is_file():
+            h.update(str(path.relative_to(project_dir)).encode())
+            h.update(path.read_bytes())
+    return h.hexdigest()
+
 
-    dockerfile = project_dir / "Dockerfile"
-    if dockerfile.exists():
+def generate_default_dockerfile(project_dir: Path):
+    # One directory scan instead of three separate stat() probes.
+    names = {entry.name for entry in os.scandir(project_dir)}
+    if "Dockerfile" in names:
         return False
+    has_req = "requirements.txt" in names
+    has_pyproject = "pyproject.toml" in names
 
-    lines = [f"FROM {DEFAULT_PYTHON_IMAGE}", "WORKDIR /app"]
+    # BuildKit cache mount: pip's download cache survives across builds,
+    # so repeat deploys with unchanged deps install in seconds.
+    pip_cache = "--mount=type=cache,target=/root/.cache/pip"
+    lines = ["# syntax=docker/dockerfile:1.4", f"FROM {DEFAULT_PYTHON_IMAGE}", "WORKDIR /app"]
     if has_req:
-        lines += ["COPY requirements.txt ./", "RUN pip install --no-cache-dir -r requirements.txt"]
+        lines += ["COPY requirements.txt ./", f"RUN {pip_cache} pip install -r requirements.txt"]
     elif has_pyproject:
-        lines += ["COPY pyproject.toml ./", "RUN pip install --no-cache-dir ."]
+        lines += ["COPY pyproject.toml ./", f"RUN {pip_cache} pip install ."]
     else:
         lines += ["# No requirements detected", "# If your bot needs packages, add requirements.txt to ZIP"]
 
     lines += ["COPY . .", "CMD [\"python\", \"main.py\"]"]
-    dockerfile.write_text("\n".join(lines))
+    (project_dir / "Dockerfile").write_bytes("\n".join(lines).encode())
     return True
 
 
-async def build_and_run(project_dir: Path, image_tag: str, container_name: str):
-    success, out = await run_cmd(f"docker build -t {image_tag} .", cwd=str(project_dir), timeout=DOCKER_BUILD_TIMEOUT)
+async def _remove_existing_container(name: str):
+    """Idempotent pre-run cleanup via the Engine API; 404 means nothing to remove."""
+    try:
+        container = await get_docker().containers.get(name)
+        await container.delete(force=True)
+    except aiodocker.DockerError as e:
+        if e.status != 404:
+            raise
+
+
+async def build_and_run(project_dir: Path, image_tag: str, container_name: str, progress=None, skip_build=False):
+    global _builds_in_flight
+    # Remove any stale container of the same name concurrently with the
+    # build; only the `docker run` below needs it gone.
+    cleanup = asyncio.create_task(_remove_existing_container(container_name))
+
+    if skip_build:
+        success, out = True, ""
+    else:
+        async with BUILD_SEM:
+            _builds_in_flight += 1
+            try:
+                success, out = await run_cmd_streamed(
+                    "docker", "build", "-t", image_tag, ".",
+                    cwd=str(project_dir), timeout=DOCKER_BUILD_TIMEOUT,
+                    env={**os.environ, "DOCKER_BUILDKIT": "1"}, on_output=progress,
+                )
+            finally:
+                _builds_in_flight -= 1
     if not success:
+        await cleanup
         return False, f"Build failed:\n{out}"
 
-    await run_cmd(f"docker rm -f {container_name} || true")
+    await cleanup
 
-    run_cmd_line = (
-        f"docker run -d --name {container_name} --restart=always --memory=256m --cpus=0.5 {DOCKER_RUN_EXTRA} {image_tag}"
+    success, out = await run_cmd(
+        "docker", "run", "-d", "--name", container_name, "--restart=always",
+        "--memory=256m", "--cpus=0.5", "--label", MANAGED_LABEL,
+        *shlex.split(DOCKER_RUN_EXTRA), image_tag,
     )
-    success, out = await run_cmd(run_cmd_line)
     if not success:
         return False, f"Run failed:\n{out}"
 
@@ -149,7 +367,7 @@ async def handle_zip(message: Message):
 
     caption = (message.caption or "").strip()
     name = None
-    m = re.search(r"name:([a-zA-Z0-9_.-]+)", caption)
+    m = _CAPTION_NAME_RE.search(caption)
     if m:
         name = m.group(1)
     else:
@@ -157,29 +375,96 @@ async def handle_zip(message: Message):
 
     name = sanitize_name(name)
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+
+    chat_id = message.chat.id
+    queue = _deploy_queues.setdefault(chat_id, asyncio.Queue(maxsize=DEPLOY_QUEUE_MAXSIZE))
+    try:
+        queue.put_nowait((message, doc, name, ts))
+    except asyncio.QueueFull:
+        await message.answer("Busy: too many pending deploys for this chat, try again later.")
+        return
+
+    worker = _deploy_workers.get(chat_id)
+    if worker is None or worker.done():
+        _deploy_workers[chat_id] = asyncio.create_task(_deploy_worker(chat_id))
+
+
+async def _deploy_worker(chat_id: int):
+    queue = _deploy_queues[chat_id]
+    while True:
+        try:
+            message, doc, name, ts = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            _deploy_workers.pop(chat_id, None)
+            return
+        try:
+            await _process_deploy(message, doc, name, ts)
+        except Exception as e:
+            await message.answer(f"Deployment error: {e}")
+        finally:
+            queue.task_done()
+
+
+async def _process_deploy(message: Message, doc, name: str, ts: str):
     project_dir = BASE_DIR / f"{name}_{ts}"
     ensure_base_dir()
     project_dir.mkdir(parents=True, exist_ok=True)
 
     await message.answer(f"Receiving {doc.file_name}... saving to {project_dir}")
     file_path = project_dir / doc.file_name
-    await bot.download(doc, destination=file_path)
-
+    # Stream to a tempfile in chunks (aiogram accepts a binary file object)
+    # so a large ZIP never sits fully in memory, then rename into place.
+    tmp = tempfile.NamedTemporaryFile(dir=project_dir, delete=False, suffix=".zip")
     try:
-        shutil.unpack_archive(str(file_path), str(project_dir))
-    except Exception as e:
-        await message.answer(f"Failed to extract zip: {e}")
+        await bot.download(doc, destination=tmp)
+    finally:
+        tmp.close()
+    os.replace(tmp.name, file_path)
+
+    # Reject non-ZIP uploads from the end-of-file record alone, before
+    # paying for a full extraction and its cleanup.
+    if not await asyncio.to_thread(zipfile.is_zipfile, file_path):
+        await message.answer(f"{doc.file_name} is not a valid ZIP file.")
+        shutil.rmtree(project_dir, ignore_errors=True)
         return
 
-    generated = generate_default_dockerfile(project_dir)
-    if generated:
-        await message.answer("No Dockerfile found, generated a default Dockerfile (expects main.py or requirements.txt).")
+    async with DEPLOY_SEM:
+        try:
+            await asyncio.to_thread(_extract_zip, file_path, project_dir)
+        except Exception as e:
+            await message.answer(f"Failed to extract zip: {e}")
+            return
 
-    image_tag = f"deploybot/{name}:{ts}"
-    container_name = f"deploy_{name}_{ts}"
+        generated = await asyncio.to_thread(generate_default_dockerfile, project_dir)
+        if generated:
+            await message.answer("No Dockerfile found, generated a default Dockerfile (expects main.py or requirements.txt).")
 
-    msg = await message.answer("Building Docker image, this may take a minute...")
-    success, out = await build_and_run(project_dir, image_tag, container_name)
+        tree_hash = await asyncio.to_thread(_project_hash, project_dir)
+        image_tag = f"deploybot/{name}:{tree_hash}"
+        container_name = f"deploy_{name}_{ts}"
+
+        try:
+            await get_docker().images.inspect(image_tag)
+            image_exists = True
+        except Exception:
+            image_exists = False
+
+        if image_exists:
+            msg = await message.answer("Image for this exact content already built, starting container...")
+        else:
+            msg = await message.answer("Building Docker image, this may take a minute...")
+
+        async def _progress(tail_lines):
+            snippet = html.quote("".join(tail_lines[-10:])[-3500:])
+            try:
+                await msg.edit_text(f"Building...\n<pre>{snippet}</pre>", parse_mode="HTML")
+            except Exception:
+                pass  # best-effort progress; edits may race or repeat
+
+        success, out = await build_and_run(
+            project_dir, image_tag, container_name,
+            progress=_progress, skip_build=image_exists,
+        )
     if success:
         await msg.edit_text(f"✅ Deployed as container `{container_name}` using image `{image_tag}`.\nUse /list to see running ones.", parse_mode="Markdown")
     else:
@@ -191,14 +476,33 @@ async def cmd_list(message: Message):
     if not is_admin(message.from_user.id):
         await message.answer("You are not allowed to use this command.")
         return
-    ok, out = await run_cmd("docker ps --format \"{{.Names}}\t{{.Image}}\t{{.Status}}\"")
-    if not ok:
+    try:
+        containers = await get_docker().containers.list(
+            filters=json.dumps({"label": [MANAGED_LABEL]})
+        )
+    except Exception:
         await message.answer("Failed to list containers. Is Docker running on this host?")
         return
-    text = out.strip() or "No running containers"
+    rows = [
+        f"{c['Names'][0].lstrip('/')}\t{c['Image']}\t{c['Status']}"
+        for c in containers
+    ]
+    text = "\n".join(rows) or "No running containers"
     await message.answer(f"Running containers:\n<pre>{text}</pre>", parse_mode="HTML")
 
 
+@dp.message(Command("status"))
+async def cmd_status(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("You are not allowed to use this command.")
+        return
+    queued = sum(q.qsize() for q in _deploy_queues.values())
+    await message.answer(
+        f"Builds in flight: {_builds_in_flight}/{MAX_CONCURRENT_BUILDS}\n"
+        f"Queued deploys: {queued}"
+    )
+
+
 @dp.message(Command("logs"))
 async def cmd_logs(message: Message, command: CommandObject):
     if not is_admin(message.from_user.id):
@@ -208,19 +512,22 @@ async def cmd_logs(message: Message, command: CommandObject):
         await message.answer("Usage: /logs <container_name>")
         return
     name = command.args.strip()
-    ok, out = await run_cmd(f"docker logs --tail 200 {name}")
-    if not ok:
-        await message.answer(f"Failed to fetch logs for {name}.\n{out}")
+    try:
+        container = await get_docker().containers.get(name)
+        lines = await container.log(stdout=True, stderr=True, tail=200)
+    except Exception as e:
+        await message.answer(f"Failed to fetch logs for {name}.\n{e}")
         return
-    if len(out) > 3900:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".log") as f:
-            f.write(out.encode())
-            tmp_name = f.name
-        await message.answer_document(FSInputFile(tmp_name), caption=f"Logs for {name}")
-        try:
-            os.unlink(tmp_name)
-        except:
-            pass
+    # tail=200 already caps the payload daemon-side; follow-mode streaming
+    # would block on a running container once the tail is drained, so the
+    # list response stays. Size is totalled per line to pick the reply form.
+    size = sum(len(line) for line in lines)
+    out = "".join(lines)
+    if size > 3900:
+        await message.answer_document(
+            BufferedInputFile(out.encode("utf-8", errors="ignore"), filename=f"{name}.log"),
+            caption=f"Logs for {name}",
+        )
     else:
         await message.answer(f"Logs for {name}:\n<pre>{out}</pre>", parse_mode="HTML")
 
@@ -234,9 +541,11 @@ async def cmd_stop(message: Message, command: CommandObject):
         await message.answer("Usage: /stop <container_name>")
         return
     name = command.args.strip()
-    ok, out = await run_cmd(f"docker stop {name}")
-    if not ok:
-        await message.answer(f"Failed to stop {name}:\n{out}")
+    try:
+        container = await get_docker().containers.get(name)
+        await container.stop()
+    except Exception as e:
+        await message.answer(f"Failed to stop {name}:\n{e}")
     else:
         await message.answer(f"Stopped {name}")
 
@@ -250,9 +559,11 @@ async def cmd_remove(message: Message, command: CommandObject):
         await message.answer("Usage: /remove <container_name>")
         return
     name = command.args.strip()
-    ok, out = await run_cmd(f"docker rm -f {name}")
-    if not ok:
-        await message.answer(f"Failed to remove {name}:\n{out}")
+    try:
+        container = await get_docker().containers.get(name)
+        await container.delete(force=True)
+    except Exception as e:
+        await message.answer(f"Failed to remove {name}:\n{e}")
     else:
         await message.answer(f"Removed {name}")
 
@@ -262,7 +573,11 @@ async def cmd_remove(message: Message, command: CommandObject):
 async def main():
     print("Starting DeployBot...")
     ensure_base_dir()
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if _docker is not None:
+            await _docker.close()
 
 
 if __name__ == "__main__":